@@ -1,11 +1,14 @@
 """CRUD operations for the application."""
 
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 from . import models, schemas, utils
 
 
-def get_user(db: Session, user_id: int) -> models.User:
+async def get_user(db: AsyncSession, user_id: int) -> models.User:
     """
     Get a user by ID.
     
@@ -13,10 +16,10 @@ def get_user(db: Session, user_id: int) -> models.User:
     :param user_id: User ID
     :return: User
     """
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return await db.get(models.User, user_id)
 
 
-def get_user_by_email(db: Session, email: str) -> models.User:
+async def get_user_by_email(db: AsyncSession, email: str) -> models.User:
     """
     Get a user by email.
 
@@ -24,10 +27,13 @@ def get_user_by_email(db: Session, email: str) -> models.User:
     :param email: User email
     :return: User
     """
-    return db.query(models.User).filter(models.User.email == email).first()
+    result = await db.execute(select(models.User)
+                              .options(selectinload(models.User.cms))
+                              .where(models.User.email == email))
+    return result.scalars().first()
 
 
-def get_user_by_api_key(db: Session, api_key: str) -> models.User:
+async def get_user_by_api_key(db: AsyncSession, api_key: str) -> models.User:
     """
     Get a user by API key.
 
@@ -35,10 +41,11 @@ def get_user_by_api_key(db: Session, api_key: str) -> models.User:
     :param api_key: API key
     :return: User
     """
-    return db.query(models.User).filter(models.User.api_key == api_key).first()
+    result = await db.execute(select(models.User).where(models.User.api_key == api_key))
+    return result.scalars().first()
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100) -> list[models.User]:
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100) -> list[models.User]:
     """
     Get all users.
 
@@ -47,10 +54,14 @@ def get_users(db: Session, skip: int = 0, limit: int = 100) -> list[models.User]
     :param limit: Number of users to return
     :return: List of users
     """
-    return db.query(models.User).offset(skip).limit(limit).all()
+    result = await db.execute(select(models.User)
+                              .options(selectinload(models.User.cms))
+                              .offset(skip)
+                              .limit(limit))
+    return result.scalars().all()
 
 
-def create_user(db: Session, user: schemas.UserSignUp) -> models.User:
+async def create_user(db: AsyncSession, user: schemas.UserSignUp) -> models.User:
     """
     Create a new user.
 
@@ -60,16 +71,30 @@ def create_user(db: Session, user: schemas.UserSignUp) -> models.User:
     """
     db_user = models.User(
         email=user.email,
-        hashed_password=utils.hash_password(user.password),
-        api_key=utils.generate_api_key()
+        hashed_password=await run_in_threadpool(utils.hash_password, user.password),
+        api_key=utils.generate_api_key(),
+        cms=[]
         )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
     return db_user
 
 
-def get_cms(db: Session, skip: int = 0, limit: int = 100) -> list[models.ConfusionMatrix]:
+async def update_user_password(db: AsyncSession, db_user: models.User, password: str) -> models.User:
+    """
+    Replace the stored password hash of a user.
+
+    :param db: Database connection
+    :param db_user: User
+    :param password: Plain password
+    :return: Updated user
+    """
+    db_user.hashed_password = await run_in_threadpool(utils.hash_password, password)
+    await db.commit()
+    return db_user
+
+
+async def get_cms(db: AsyncSession, skip: int = 0, limit: int = 100) -> list[models.ConfusionMatrix]:
     """
     Get all confusion matrices.
 
@@ -78,10 +103,13 @@ def get_cms(db: Session, skip: int = 0, limit: int = 100) -> list[models.Confusi
     :param limit: Number of confusion matrices to return
     :return: List of confusion matrices
     """
-    return db.query(models.ConfusionMatrix).offset(skip).limit(limit).all()
+    result = await db.execute(select(models.ConfusionMatrix).offset(skip).limit(limit))
+    return result.scalars().all()
 
 
-def create_cm_for_user(db: Session, cm: schemas.ConfusionMatrixCreate, user: models.User) -> models.ConfusionMatrix:
+async def create_cm_for_user(db: AsyncSession,
+                             cm: schemas.ConfusionMatrixCreate,
+                             user: models.User) -> models.ConfusionMatrix:
     """
     Create a new confusion matrix for a user.
     
@@ -90,16 +118,15 @@ def create_cm_for_user(db: Session, cm: schemas.ConfusionMatrixCreate, user: mod
     :param user: User
     :return: Created confusion matrix
     """
-    cm_uid = utils.generate_cm_uid(user.email)
-    utils.save_cm(cm_uid, cm)
+    cm_uid = utils.generate_cm_uid()
+    await run_in_threadpool(utils.save_cm, cm_uid, cm)
     db_cm = models.ConfusionMatrix(uid=cm_uid, owner_id=user.id)
     db.add(db_cm)
-    db.commit()
-    db.refresh(db_cm)
+    await db.commit()
     return db_cm
 
 
-def get_cm_by_uid(db: Session, cm_uid: str) -> models.ConfusionMatrix:
+async def get_cm_by_uid(db: AsyncSession, cm_uid: str) -> models.ConfusionMatrix:
     """
     Get a confusion matrix by UID.
 
@@ -107,10 +134,40 @@ def get_cm_by_uid(db: Session, cm_uid: str) -> models.ConfusionMatrix:
     :param cm_uid: Confusion matrix UID
     :return: Confusion matrix
     """
-    return db.query(models.ConfusionMatrix).filter(models.ConfusionMatrix.uid == cm_uid).first()
+    result = await db.execute(select(models.ConfusionMatrix).where(models.ConfusionMatrix.uid == cm_uid))
+    return result.scalars().first()
+
+
+async def get_cms_by_uids(db: AsyncSession, cm_uids: list[str]) -> list[models.ConfusionMatrix]:
+    """
+    Get confusion matrices by UIDs in a single query.
+
+    :param db: Database connection
+    :param cm_uids: Confusion matrix UIDs
+    :return: List of found confusion matrices (in no particular order)
+    """
+    result = await db.execute(select(models.ConfusionMatrix).where(models.ConfusionMatrix.uid.in_(cm_uids)))
+    return result.scalars().all()
+
+
+async def get_user_and_cm(db: AsyncSession,
+                          api_key: str,
+                          cm_uid: str) -> tuple[models.User, models.ConfusionMatrix] | None:
+    """
+    Get a user by API key together with a confusion matrix by UID in a single query.
+
+    :param db: Database connection
+    :param api_key: API key
+    :param cm_uid: Confusion matrix UID
+    :return: (User, Confusion matrix or None) or None if the API key is invalid
+    """
+    result = await db.execute(select(models.User, models.ConfusionMatrix)
+                              .outerjoin(models.ConfusionMatrix, models.ConfusionMatrix.uid == cm_uid)
+                              .where(models.User.api_key == api_key))
+    return result.first()
 
 
-def delete_cm_by_uid(db: Session, cm_uid: str):
+async def delete_cm_by_uid(db: AsyncSession, cm_uid: str):
     """
     Delete a confusion matrix by UID.
 
@@ -118,6 +175,6 @@ def delete_cm_by_uid(db: Session, cm_uid: str):
     :param cm_uid: Confusion matrix UID
     :return: None
     """
-    db_cm = get_cm_by_uid(db, cm_uid)
-    db.delete(db_cm)
-    db.commit()
+    db_cm = await get_cm_by_uid(db, cm_uid)
+    await db.delete(db_cm)
+    await db.commit()
@@ -1,18 +1,68 @@
 """Database configuration and session management."""
 
-from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
 from .params import SQLALCHEMY_DATABASE_URL
+from .params import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE
 
-engine = create_engine(
+engine = create_async_engine(
     SQLALCHEMY_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
     connect_args={"check_same_thread": False}
 )
-SessionLocal = sessionmaker(
-    autocommit=False,
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record) -> None:
+    """
+    Enable WAL journaling on every new SQLite connection.
+
+    :param dbapi_connection: Raw DBAPI connection
+    :param connection_record: Pool connection record
+    :return: None
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+SessionLocal = async_sessionmaker(
+    bind=engine,
     autoflush=False,
-    bind=engine)
+    expire_on_commit=False)
 
 Base = declarative_base()
+
+
+def create_indexes(connection) -> None:
+    """
+    Create model indexes missing from an already existing database.
+
+    `create_all` skips tables that already exist, so indexes added to the
+    models later would otherwise never reach older databases.
+
+    :param connection: Synchronous database connection
+    :return: None
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+
+async def init_db() -> None:
+    """
+    Create missing tables and indexes.
+
+    :return: None
+    """
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.run_sync(create_indexes)
@@ -1,37 +1,139 @@
 """Main application file for the FastAPI app."""
 
-from typing import Annotated
+import os
+import itertools
+from contextlib import asynccontextmanager
+from typing import Annotated, Iterable, Iterator
 
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.routing import APIRouter
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import Response, HTMLResponse, FileResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import Response, FileResponse, ORJSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from . import crud, models, schemas, utils
-from .database import SessionLocal, engine
+from .database import SessionLocal, init_db
+from .params import PLOT_CACHE_CONTROL
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Prepare the database before serving requests.
+
+    :param app: FastAPI app
+    :return: None
+    """
+    await init_db()
+    yield
+
 
-models.Base.metadata.create_all(bind=engine)
 security = HTTPBasic()
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 # Dependency
-def get_db():
+async def get_db():
     """
     Dependency to get a database connection.
     
     :return: Database connection
     """
-    db = SessionLocal()
-    try:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+async def get_current_user(db: AsyncSession, api_key: str) -> models.User:
+    """
+    Get the user holding an API key.
+
+    :param db: Database connection
+    :param api_key: API key of the user
+    :return: User
+    """
+    user = await crud.get_user_by_api_key(db, api_key)
+    if user is None:
+        raise HTTPException(status_code=404, detail="Invalid API key")
+    return user
+
+
+async def check_api_key(api_key: str) -> models.User:
+    """
+    Get the user holding an API key, releasing the database connection right away.
+
+    :param api_key: API key of the user
+    :return: User
+    """
+    async with SessionLocal() as db:
+        return await get_current_user(db, api_key)
+
+
+async def get_owned_cm(db: AsyncSession, api_key: str, cm_uid: str) -> tuple[models.User, models.ConfusionMatrix]:
+    """
+    Get a confusion matrix and its owner, checking the ownership.
+
+    :param db: Database connection
+    :param api_key: API key of the owner
+    :param cm_uid: UID of the confusion matrix
+    :return: Owner and confusion matrix
+    """
+    user_and_cm = await crud.get_user_and_cm(db, api_key, cm_uid)
+    if user_and_cm is None:
+        raise HTTPException(status_code=404, detail="Invalid API key")
+    user, cm_db = user_and_cm
+    if cm_db is None:
+        raise HTTPException(status_code=404, detail="Confusion matrix not found")
+    if cm_db.owner_id != user.id:
+        raise HTTPException(status_code=401, detail="Unauthorized access")
+    return user, cm_db
+
+
+async def require_owned_cm(api_key: str,
+                           cm_uid: str,
+                           db: AsyncSession = Depends(get_db)) -> tuple[models.User, models.ConfusionMatrix]:
+    """
+    Dependency to get a confusion matrix owned by the API key holder.
+
+    :param api_key: API key of the owner
+    :param cm_uid: UID of the confusion matrix
+    :param db: Database connection
+    :return: Owner and confusion matrix
+    """
+    return await get_owned_cm(db, api_key, cm_uid)
+
+
+def is_not_modified(request: Request, response: FileResponse) -> bool:
+    """
+    Check if the client already holds the current version of a file response.
+
+    :param request: Incoming request
+    :param response: File response with stat headers set
+    :return: True if a 304 response can be sent, False otherwise
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return response.headers["etag"] in [etag.strip() for etag in if_none_match.split(",")]
+    return request.headers.get("if-modified-since") == response.headers["last-modified"]
+
+
+def stream_json_array(items: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Stream already encoded JSON items as a JSON array.
+
+    :param items: Encoded JSON items
+    :return: JSON array chunks
+    """
+    yield b"["
+    for index, item in enumerate(items):
+        if index > 0:
+            yield b","
+        yield item
+    yield b"]"
 
 
 @app.get("/")
-def root():
+async def root():
     """
     Root path of the API.
     
@@ -41,10 +143,10 @@ def root():
 
 
 @app.get("/users/", response_model=list[schemas.User])
-def get_users(credentials: Annotated[HTTPBasicCredentials, Depends(security)],
-              skip: int = 0,
-              limit: int = 100,
-              db: Session = Depends(get_db)):
+async def get_users(credentials: Annotated[HTTPBasicCredentials, Depends(security)],
+                    skip: int = 0,
+                    limit: int = 100,
+                    db: AsyncSession = Depends(get_db)):
     """
     Get all users.
     
@@ -56,13 +158,13 @@ def get_users(credentials: Annotated[HTTPBasicCredentials, Depends(security)],
     """
     if not utils.authorize_admin(credentials.username, credentials.password):
         raise HTTPException(status_code=401, detail="Unauthorized access")
-    users = crud.get_users(db, skip=skip, limit=limit)
+    users = await crud.get_users(db, skip=skip, limit=limit)
     return users
 
 
 @app.post("/sign_up/", response_model=schemas.User)
-def sign_up(user: schemas.UserSignUp,
-                db: Session = Depends(get_db)):
+async def sign_up(user: schemas.UserSignUp,
+                  db: AsyncSession = Depends(get_db)):
     """
     Sign up a new user.
     
@@ -70,15 +172,15 @@ def sign_up(user: schemas.UserSignUp,
     :param db: Database connection
     :return: Created user
     """
-    db_user = crud.get_user_by_email(db, email=user.email)
+    db_user = await crud.get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+    return await crud.create_user(db=db, user=user)
 
 
 @app.post("/sign_in/", response_model=schemas.User)
-def sign_in(user: schemas.UserSingIn,
-              db: Session = Depends(get_db)):
+async def sign_in(user: schemas.UserSingIn,
+                  db: AsyncSession = Depends(get_db)):
     """
     Sign in a user.
 
@@ -86,11 +188,13 @@ def sign_in(user: schemas.UserSingIn,
     :param db: Database connection
     :return: Signed in user
     """
-    db_user = crud.get_user_by_email(db, email=user.email)
+    db_user = await crud.get_user_by_email(db, email=user.email)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    if db_user.hashed_password != utils.hash_password(user.password):
+    if not await run_in_threadpool(utils.verify_password, db_user.hashed_password, user.password):
         raise HTTPException(status_code=400, detail="Invalid password")
+    if utils.password_needs_rehash(db_user.hashed_password):
+        db_user = await crud.update_user_password(db, db_user, user.password)
     return db_user
 
 
@@ -99,10 +203,10 @@ def sign_in(user: schemas.UserSingIn,
 
 
 @app.get("/cms/", response_model=list[schemas.ConfusionMatrixResponseBase])
-def read_confusion_matrices(credentials: Annotated[HTTPBasicCredentials, Depends(security)],
-                            skip: int = 0,
-                            limit: int = 100,
-                            db: Session = Depends(get_db)):
+async def read_confusion_matrices(credentials: Annotated[HTTPBasicCredentials, Depends(security)],
+                                  skip: int = 0,
+                                  limit: int = 100,
+                                  db: AsyncSession = Depends(get_db)):
     """
     Get all confusion matrices.
 
@@ -114,14 +218,17 @@ def read_confusion_matrices(credentials: Annotated[HTTPBasicCredentials, Depends
     """
     if not utils.authorize_admin(credentials.username, credentials.password):
         raise HTTPException(status_code=401, detail="Unauthorized access")
-    cms = crud.get_cms(db, skip=skip, limit=limit)
-    cms = [utils.load_cm(cm_db) for cm_db in cms]
-    return cms
+    cms_db = await crud.get_cms(db, skip=skip, limit=limit)
+    # Load the first row before streaming, so a failure still gets an error status
+    first_cms_json = await run_in_threadpool(lambda: [utils.load_cm_json(cm_db) for cm_db in cms_db[:1]])
+    rest_cms_json = (utils.load_cm_json(cm_db) for cm_db in cms_db[1:])
+    return StreamingResponse(stream_json_array(itertools.chain(first_cms_json, rest_cms_json)),
+                             media_type="application/json")
 
 
 @app.post("/cm/create", response_model=schemas.ConfusionMatrix)
-def create_confusion_matrix(cm: schemas.ConfusionMatrixCreate,
-                            db: Session = Depends(get_db)):
+async def create_confusion_matrix(cm: schemas.ConfusionMatrixCreate,
+                                  db: AsyncSession = Depends(get_db)):
     """
     Create a new confusion matrix.
     
@@ -129,16 +236,14 @@ def create_confusion_matrix(cm: schemas.ConfusionMatrixCreate,
     :param db: Database connection
     :return: Created confusion matrix
     """
-    user = crud.get_user_by_api_key(db, cm.api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    return crud.create_cm_for_user(db=db, cm=cm, user=user)
+    user = await get_current_user(db, cm.api_key)
+    return await crud.create_cm_for_user(db=db, cm=cm, user=user)
 
 
 @app.post("/cm/update", response_model=schemas.ConfusionMatrix)
-def update_confusion_matrix(cm_uid: str,
-                            cm: schemas.ConfusionMatrixCreate,
-                            db: Session = Depends(get_db)):
+async def update_confusion_matrix(cm_uid: str,
+                                  cm: schemas.ConfusionMatrixCreate,
+                                  db: AsyncSession = Depends(get_db)):
     """
     Update an existing confusion matrix.
     
@@ -147,132 +252,94 @@ def update_confusion_matrix(cm_uid: str,
     :param db: Database connection
     :return: Updated confusion matrix
     """
-    user = crud.get_user_by_api_key(db, cm.api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    cm_db = crud.get_cm_by_uid(db, cm_uid)
-    if cm_db is None:
-        raise HTTPException(status_code=404, detail="Confusion matrix not found")
-    utils.save_cm(cm_db.uid, cm)
+    _, cm_db = await get_owned_cm(db, cm.api_key, cm_uid)
+    await run_in_threadpool(utils.save_cm, cm_db.uid, cm)
     return cm_db
 
 
 @app.get("/cm/", response_model=schemas.ConfusionMatrixResponseBase)
-def read_confusion_matrix(api_key: str,
-                          cm_uid: str,
-                          db: Session = Depends(get_db)):
+async def read_confusion_matrix(owned_cm: tuple[models.User, models.ConfusionMatrix] = Depends(require_owned_cm)):
     """
     Get a confusion matrix.
 
-    :param api_key: API key of the owner
-    :param cm_uid: UID of the confusion matrix
-    :param db: Database connection
+    :param owned_cm: Owner and confusion matrix
     :return: Confusion matrix
     """
-    user = crud.get_user_by_api_key(db, api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    cm_db = crud.get_cm_by_uid(db, cm_uid)
-    if cm_db is None:
-        raise HTTPException(status_code=404, detail="Confusion matrix not found")
-    if cm_db.owner_id != user.id:
-        raise HTTPException(status_code=401, detail="Unauthorized access")
-    return utils.load_cm(cm_db)
+    _, cm_db = owned_cm
+    return await run_in_threadpool(utils.load_cm, cm_db)
 
 
 @app.delete("/cm/{cm_uid}")
-def delete_confusion_matrix(api_key: str,
-                            cm_uid: str,
-                            db: Session = Depends(get_db)):
+async def delete_confusion_matrix(owned_cm: tuple[models.User, models.ConfusionMatrix] = Depends(require_owned_cm),
+                                  db: AsyncSession = Depends(get_db)):
     """
     Delete a confusion matrix.
 
-    :param api_key: API key of the owner
-    :param cm_uid: UID of the confusion matrix
+    :param owned_cm: Owner and confusion matrix
     :param db: Database connection
     :return: Message indicating the deletion
     """
-    user = crud.get_user_by_api_key(db, api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    cm_db = crud.get_cm_by_uid(db, cm_uid)
-    if cm_db is None:
-        raise HTTPException(status_code=404, detail="Confusion matrix not found")
-    if cm_db.owner_id != user.id:
-        raise HTTPException(status_code=401, detail="Unauthorized access")
-    crud.delete_cm_by_uid(db, cm_uid)
+    _, cm_db = owned_cm
+    await crud.delete_cm_by_uid(db, cm_db.uid)
     return {"message": "Confusion matrix deleted"}
 
 
-@app.get("/cm/report", response_class=HTMLResponse)
-def get_confusion_matrix_report(api_key: str,
-                                cm_uid: str,
-                                db: Session = Depends(get_db)):
+@app.get("/cm/report", response_class=FileResponse)
+async def get_confusion_matrix_report(owned_cm: tuple[models.User, models.ConfusionMatrix] = Depends(require_owned_cm)):
     """
     Get the report of a confusion matrix.
 
-    :param api_key: API key of the owner
-    :param cm_uid: UID of the confusion matrix
-    :param db: Database connection
+    :param owned_cm: Owner and confusion matrix
     :return: Confusion matrix report
     """
-    user = crud.get_user_by_api_key(db, api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    cm_db = crud.get_cm_by_uid(db, cm_uid)
-    if cm_db is None:
-        raise HTTPException(status_code=404, detail="Confusion matrix not found")
-    if cm_db.owner_id != user.id:
-        raise HTTPException(status_code=401, detail="Unauthorized access")
-    return utils.get_html_report(cm_db)
+    _, cm_db = owned_cm
+    path_to_html = await run_in_threadpool(utils.get_html_report, cm_db)
+    return FileResponse(path_to_html, media_type="text/html")
 
 
 # TODO: Should be test on ubuntu
 #   Also try saving file if it keeps failing.
 @app.get("/cm/plot", response_class=FileResponse)
-def get_confusion_matrix_plot(api_key: str,
-                              cm_uid: str,
-                              db: Session = Depends(get_db)):
+async def get_confusion_matrix_plot(request: Request,
+                                    owned_cm: tuple[models.User, models.ConfusionMatrix] = Depends(require_owned_cm)):
     """
     Get the confusion matrix plot.
 
-    :param api_key: API key of the owner
-    :param cm_uid: UID of the confusion matrix
-    :param db: Database connection
+    :param request: Incoming request
+    :param owned_cm: Owner and confusion matrix
     :return: Confusion matrix plot
     """
-    user = crud.get_user_by_api_key(db, api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    cm_db = crud.get_cm_by_uid(db, cm_uid)
-    if cm_db is None:
-        raise HTTPException(status_code=404, detail="Confusion matrix not found")
-    if cm_db.owner_id != user.id:
-        raise HTTPException(status_code=401, detail="Unauthorized access")
-    path_to_img = utils.get_plot(cm_db)
-    return path_to_img
+    _, cm_db = owned_cm
+    path_to_img = await run_in_threadpool(utils.get_plot, cm_db)
+    response = FileResponse(path_to_img,
+                            media_type="image/png",
+                            headers={"Cache-Control": PLOT_CACHE_CONTROL},
+                            stat_result=os.stat(path_to_img))
+    if is_not_modified(request, response):
+        return Response(status_code=304,
+                        headers={"ETag": response.headers["etag"],
+                                 "Last-Modified": response.headers["last-modified"],
+                                 "Cache-Control": PLOT_CACHE_CONTROL})
+    return response
 
 
 # TODO: Fix the validation error
 @app.post("/curve", response_model=schemas.CurveResponseBase)
-def get_curve(curve: schemas.CurveCreate, db: Session = Depends(get_db)):
+async def get_curve(curve: schemas.CurveCreate):
     """
     Get the curve object for the given input.
 
     :param curve: Curve information
-    :param db: Database connection
     :return: Curve object
     """
-    user = crud.get_user_by_api_key(db, curve.api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    curve_obj = utils.get_curve(curve)
+    await check_api_key(curve.api_key)
+    curve_obj = await run_in_threadpool(utils.get_curve, curve)
     return curve_obj
 
 
 @app.post("/compare/", response_model=schemas.ConfusionMatrixCompareResponseBase)
-def compare_confusion_matrices(compare_request: schemas.ConfusionMatrixCompareRequestBase,
-                               db: Session = Depends(get_db)):
+async def compare_confusion_matrices(compare_request: schemas.ConfusionMatrixCompareRequestBase,
+                                     db: AsyncSession = Depends(get_db)):
     """
     Compare two confusion matrices.
     
@@ -280,29 +347,24 @@ def compare_confusion_matrices(compare_request: schemas.ConfusionMatrixCompareRe
     :param db: Database connection
     :return: Comparison result
     """
-    user = crud.get_user_by_api_key(db, compare_request.api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    cms = [crud.get_cm_by_uid(db, cm_uid) for cm_uid in compare_request.cm_uids]
-    if any([cm is None for cm in cms]):
+    user = await get_current_user(db, compare_request.api_key)
+    cms_by_uid = {cm.uid: cm for cm in await crud.get_cms_by_uids(db, compare_request.cm_uids)}
+    if len(cms_by_uid) != len(set(compare_request.cm_uids)):
         raise HTTPException(status_code=404, detail="Confusion matrix not found")
+    cms = [cms_by_uid[cm_uid] for cm_uid in compare_request.cm_uids]
     if any([cm.owner_id != user.id for cm in cms]):
         raise HTTPException(status_code=401, detail="Unauthorized access")
-    return utils.compare_cm(cms)
+    return await run_in_threadpool(utils.compare_cm, cms)
 
 
 # One time use, no database storing
 @app.post("/mlcm/", response_model=schemas.MultiLabelConfusionMatrixResponseBase)
-def create_multi_label_confusion_matrix(mlcm: schemas.MultiLabelConfusionMatrixCreate,
-                                        db: Session = Depends(get_db)):
+async def create_multi_label_confusion_matrix(mlcm: schemas.MultiLabelConfusionMatrixCreate):
     """
     Create a multi-label confusion matrix.
 
     :param mlcm: Multi-label confusion matrix information
-    :param db: Database connection
     :return: Created multi-label confusion matrix
     """
-    user = crud.get_user_by_api_key(db, mlcm.api_key)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Invalid API key")
-    return utils.get_multi_label_cm(mlcm)
+    await check_api_key(mlcm.api_key)
+    return await run_in_threadpool(utils.get_multi_label_cm, mlcm)
@@ -14,7 +14,7 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
-    api_key = Column(String)
+    api_key = Column(String, unique=True, index=True)
     credit = Column(Float, default=.0)
     is_active = Column(Boolean, default=True)
 
@@ -26,7 +26,7 @@ class ConfusionMatrix(Base):
     __tablename__ = "cms"
 
     id = Column(Integer, primary_key=True)
-    uid = Column(String, index=True)
+    uid = Column(String, unique=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
 
     owner = relationship("User", back_populates="cms")
@@ -3,7 +3,10 @@
 import os
 
 PATH2DB = os.path.join(os.path.dirname(__file__), "DB.db")
-SQLALCHEMY_DATABASE_URL = f"sqlite:///{PATH2DB}"
+SQLALCHEMY_DATABASE_URL = f"sqlite+aiosqlite:///{PATH2DB}"
+DB_POOL_SIZE = 20
+DB_MAX_OVERFLOW = 40
+DB_POOL_RECYCLE = 3600
 
 PATH2CMS = os.path.join(os.path.dirname(__file__), "cms")
 if not os.path.exists(PATH2CMS):
@@ -16,11 +19,21 @@ if not os.path.exists(PATH2PLOTS):
     os.makedirs(PATH2PLOTS)
 
 
-PASSWORD_SALT = "pycm_salt"
+# Argon2id parameters (OWASP minimum recommendation)
+PASSWORD_HASH_TIME_COST = 2
+PASSWORD_HASH_MEMORY_COST = 19 * 1024
+PASSWORD_HASH_PARALLELISM = 1
+
+# Legacy MD5 hashes, only used to migrate old accounts on sign in
+LEGACY_PASSWORD_SALT = "pycm_salt"
+LEGACY_PASSWORD_HASH_LENGTH = 32
 
 USER_UID_LENGHT = 8
 API_KEY_LENGTH = 32
 CM_OBJECT_NAME_MAIN_LENGTH = 16
+CM_CACHE_SIZE = 4096
+COMPARE_MAX_WORKERS = 8
+PLOT_CACHE_CONTROL = "public, max-age=86400"
 
 try:
     PYCM_ADMIN = os.environ['PYCM_API_ADMIN']
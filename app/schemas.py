@@ -30,8 +30,10 @@ class ConfusionMatrixDataBase(BaseModel):
     f1: float | str | None = None
     confusion_matrix: List[List[int]] | None = None
 
-    def __init__(self, cm: pycm.ConfusionMatrix, **data):
+    def __init__(self, cm: pycm.ConfusionMatrix | None = None, **data):
         super().__init__(**data)
+        if cm is None:
+            return
         self.accuracy = cm.Overall_ACC
         self.precision = cm.PPV_Macro
         self.recall = cm.TPR_Macro
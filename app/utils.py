@@ -1,12 +1,19 @@
 """Utility functions for the application."""
 
 import hashlib
+import hmac
 import secrets
 import os
 import pycm
 import io
-import matplotlib.pyplot as plt
+import numpy as np
+import functools
+import pickle
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
 from .schemas import ConfusionMatrix, ConfusionMatrixResponseBase
 from .schemas import ConfusionMatrixCreate, ConfusionMatrixCompareResponseBase
@@ -15,22 +22,72 @@ from .schemas import MultiLabelConfusionMatrixCreate
 from .schemas import MultiLabelConfusionMatrixResponseBase
 from .schemas import CurveCreate, CurveResponseBase
 from .params import PATH2CMS, PATH2REPORTS, PATH2PLOTS
-from .params import PASSWORD_SALT
+from .params import PASSWORD_HASH_TIME_COST, PASSWORD_HASH_MEMORY_COST
+from .params import PASSWORD_HASH_PARALLELISM
+from .params import LEGACY_PASSWORD_SALT, LEGACY_PASSWORD_HASH_LENGTH
 from .params import API_KEY_LENGTH, USER_UID_LENGHT
-from .params import CM_OBJECT_NAME_MAIN_LENGTH
+from .params import CM_OBJECT_NAME_MAIN_LENGTH, CM_CACHE_SIZE
+from .params import COMPARE_MAX_WORKERS
 from .params import PYCM_ADMIN, PYCM_ADMIN_PASSWORD
 from .errors import PyCMAPISaveFileError
 
 
+PASSWORD_HASHER = PasswordHasher(time_cost=PASSWORD_HASH_TIME_COST,
+                                 memory_cost=PASSWORD_HASH_MEMORY_COST,
+                                 parallelism=PASSWORD_HASH_PARALLELISM)
+_plt = None  # matplotlib.pyplot, imported on first plot
+_ADMIN_USER_BYTES = PYCM_ADMIN.encode()
+_ADMIN_PW_BYTES = PYCM_ADMIN_PASSWORD.encode()
+
+
 def hash_password(password: str) -> str:
     """
-    Hash a password using MD5 and a salt.
-    
+    Hash a password using Argon2id.
+
     :param password: Password to hash
-    :return: Hashed password
+    :return: PHC-encoded hashed password (includes the salt)
+    """
+    return PASSWORD_HASHER.hash(password)
+
+
+def _is_legacy_password_hash(hashed_password: str) -> bool:
+    """
+    Check if a hashed password is a legacy salted MD5 digest.
+
+    :param hashed_password: Stored hashed password
+    :return: True if the hash is a legacy MD5 digest, False otherwise
+    """
+    return len(hashed_password) == LEGACY_PASSWORD_HASH_LENGTH
+
+
+def verify_password(hashed_password: str, password: str) -> bool:
+    """
+    Verify a password against a stored hash.
+
+    :param hashed_password: Stored hashed password
+    :param password: Password to verify
+    :return: True if the password matches, False otherwise
     """
-    salted_password = password + PASSWORD_SALT
-    return hashlib.md5(salted_password.encode()).hexdigest()
+    if _is_legacy_password_hash(hashed_password):
+        salted_password = password + LEGACY_PASSWORD_SALT
+        legacy_hash = hashlib.md5(salted_password.encode()).hexdigest()
+        return secrets.compare_digest(hashed_password, legacy_hash)
+    try:
+        return PASSWORD_HASHER.verify(hashed_password, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """
+    Check if a stored hash should be replaced with a fresh Argon2id hash.
+
+    :param hashed_password: Stored hashed password
+    :return: True if the password should be rehashed, False otherwise
+    """
+    if _is_legacy_password_hash(hashed_password):
+        return True
+    return PASSWORD_HASHER.check_needs_rehash(hashed_password)
 
 
 def generate_api_key() -> str:
@@ -42,16 +99,15 @@ def generate_api_key() -> str:
     return secrets.token_urlsafe(API_KEY_LENGTH)
 
 
-def generate_cm_uid(user_email: str) -> str:
+def generate_cm_uid() -> str:
     """
     Generate a confusion matrix UID.
-    
-    :param user_email: User email
+
     :return: Confusion matrix UID
     """
+    prefix_key = secrets.token_hex(USER_UID_LENGHT // 2)
     generated_key = secrets.token_urlsafe(CM_OBJECT_NAME_MAIN_LENGTH)
-    user_key = hashlib.md5(user_email.encode()).hexdigest()[:USER_UID_LENGHT]
-    return f"{user_key}:{generated_key}"
+    return f"{prefix_key}:{generated_key}"
 
 
 def authorize_admin(username: str, password: str) -> bool:
@@ -62,7 +118,74 @@ def authorize_admin(username: str, password: str) -> bool:
     :param password: Admin password
     :return: True if the admin is authorized, False otherwise
     """
-    return username == PYCM_ADMIN and password == PYCM_ADMIN_PASSWORD
+    # `&` instead of `and`, so the password is checked even if the username fails
+    return hmac.compare_digest(username.encode(), _ADMIN_USER_BYTES) & \
+        hmac.compare_digest(password.encode(), _ADMIN_PW_BYTES)
+
+
+def _write_file_atomic(path: str, data: bytes) -> None:
+    """
+    Write a file through a temporary file, so readers never see a partial file.
+
+    :param path: Destination path
+    :param data: File content
+    :return: None
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _save_cm_obj(uid: str, cm: pycm.ConfusionMatrix) -> None:
+    """
+    Save a pickled copy of a confusion matrix for fast loading.
+
+    :param uid: UID of the confusion matrix
+    :param cm: PyCM confusion matrix
+    :return: None
+    """
+    _write_file_atomic(os.path.join(PATH2CMS, uid) + '.pkl', pickle.dumps(cm, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _load_cm_obj(uid: str) -> pycm.ConfusionMatrix:
+    """
+    Load a confusion matrix, preferring the pickled copy over the object file.
+
+    A missing or unloadable pickle (e.g. written by another PyCM version)
+    is rebuilt from the object file.
+
+    :param uid: UID of the confusion matrix
+    :return: PyCM confusion matrix
+    """
+    pkl_path = os.path.join(PATH2CMS, uid) + '.pkl'
+    if os.path.exists(pkl_path):
+        try:
+            with open(pkl_path, "rb") as file:
+                return pickle.load(file)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+    with open(os.path.join(PATH2CMS, uid) + '.obj', "r") as file:
+        cm = pycm.ConfusionMatrix(file=file)
+    _save_cm_obj(uid, cm)
+    return cm
+
+
+def _save_cm_response(uid: str, cm: pycm.ConfusionMatrix) -> ConfusionMatrixResponseBase:
+    """
+    Save the computed response of a confusion matrix next to its object file.
+
+    :param uid: UID of the confusion matrix
+    :param cm: PyCM confusion matrix
+    :return: Confusion matrix response
+    """
+    cm_response = ConfusionMatrixResponseBase(uid=uid, cm=cm)
+    _write_file_atomic(os.path.join(PATH2CMS, uid) + '.json', cm_response.model_dump_json().encode())
+    return cm_response
 
 
 def save_cm(uid: str, cm: ConfusionMatrixCreate) -> None:
@@ -78,6 +201,38 @@ def save_cm(uid: str, cm: ConfusionMatrixCreate) -> None:
     result = cm.save_obj(os.path.join(PATH2CMS, uid))
     if not result['Status']:
         raise PyCMAPISaveFileError()
+    _save_cm_obj(uid, cm)
+    _save_cm_response(uid, cm)
+    for cached_path in [os.path.join(PATH2REPORTS, uid) + '.html',
+                        os.path.join(PATH2PLOTS, uid) + '.png']:
+        if os.path.exists(cached_path):
+            os.remove(cached_path)
+
+
+@functools.lru_cache(maxsize=CM_CACHE_SIZE)
+def _read_cm_response(uid: str, mtime: float) -> ConfusionMatrixResponseBase:
+    """
+    Read the saved response of a confusion matrix.
+
+    :param uid: UID of the confusion matrix
+    :param mtime: Modification time of the response file, used as cache key
+    :return: Confusion matrix response
+    """
+    with open(os.path.join(PATH2CMS, uid) + '.json', "r") as file:
+        return ConfusionMatrixResponseBase.model_validate_json(file.read())
+
+
+def _get_cm_json_path(uid: str) -> str:
+    """
+    Get the JSON sidecar path of a confusion matrix, building the sidecar if missing.
+
+    :param uid: UID of the confusion matrix
+    :return: JSON sidecar path
+    """
+    json_path = os.path.join(PATH2CMS, uid) + '.json'
+    if not os.path.exists(json_path):
+        _save_cm_response(uid, _load_cm_obj(uid))
+    return json_path
 
 
 def load_cm(cm_db: ConfusionMatrix) -> ConfusionMatrixResponseBase:
@@ -87,9 +242,34 @@ def load_cm(cm_db: ConfusionMatrix) -> ConfusionMatrixResponseBase:
     :param cm_db: Confusion matrix database object
     :return: Confusion matrix
     """
-    with open(os.path.join(PATH2CMS, cm_db.uid) + '.obj', "r") as file:
-        cm = pycm.ConfusionMatrix(file=file)
-        return ConfusionMatrixResponseBase(uid=cm_db.uid, cm=cm)
+    json_path = _get_cm_json_path(cm_db.uid)
+    return _read_cm_response(cm_db.uid, os.path.getmtime(json_path))
+
+
+def load_cm_json(cm_db: ConfusionMatrix) -> bytes:
+    """
+    Load a confusion matrix as already encoded JSON.
+
+    :param cm_db: Confusion matrix database object
+    :return: Confusion matrix JSON
+    """
+    with open(_get_cm_json_path(cm_db.uid), "rb") as file:
+        return file.read()
+
+
+def _get_pyplot():
+    """
+    Import matplotlib's pyplot with the Agg backend on first use.
+
+    :return: matplotlib.pyplot module
+    """
+    global _plt
+    if _plt is None:
+        from matplotlib import use
+        use("Agg")
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
 
 
 def get_plot(cm_db: ConfusionMatrix) -> str:
@@ -99,15 +279,17 @@ def get_plot(cm_db: ConfusionMatrix) -> str:
     :param cm_db: Confusion matrix database object
     :return: Plot path
     """
-    with open(os.path.join(PATH2CMS, cm_db.uid) + '.obj', "r") as file:
-        cm = pycm.ConfusionMatrix(file=file)
-        img_path = os.path.join(PATH2PLOTS, cm_db.uid) + '.png'
-        if os.path.exists(img_path):
-            return img_path
-        else:
-            cm.plot()
-            plt.savefig(img_path)
-            return img_path
+    img_path = os.path.join(PATH2PLOTS, cm_db.uid) + '.png'
+    if os.path.exists(img_path):
+        return img_path
+    cm = _load_cm_obj(cm_db.uid)
+    plt = _get_pyplot()
+    try:
+        cm.plot()
+        plt.savefig(img_path)
+    finally:
+        plt.close('all')
+    return img_path
 
 
 def get_curve(curve_create: CurveCreate) -> CurveResponseBase:
@@ -133,18 +315,14 @@ def get_html_report(cm_db: ConfusionMatrix) -> str:
     Get the HTML report of the confusion matrix.
 
     :param cm_db: Confusion matrix database object
-    :return: HTML report
+    :return: HTML report path
     """
-    with open(os.path.join(PATH2CMS, cm_db.uid) + '.obj', "r") as file:
-        cm = pycm.ConfusionMatrix(file=file)
-        html_path = os.path.join(PATH2REPORTS, cm_db.uid) + '.html'
-        if os.path.exists(html_path):
-            with open(html_path, "r") as html_file:
-                return html_file.read()
-        else:
-            cm.save_html(os.path.join(PATH2REPORTS, cm_db.uid))
-            with open(html_path, "r") as html_file:
-                return html_file.read()
+    html_path = os.path.join(PATH2REPORTS, cm_db.uid) + '.html'
+    if os.path.exists(html_path):
+        return html_path
+    cm = _load_cm_obj(cm_db.uid)
+    cm.save_html(os.path.join(PATH2REPORTS, cm_db.uid))
+    return html_path
 
 
 def compare_cm(cms_db: List[ConfusionMatrix]) -> ConfusionMatrixCompareResponseBase:
@@ -154,18 +332,68 @@ def compare_cm(cms_db: List[ConfusionMatrix]) -> ConfusionMatrixCompareResponseB
     :param cms_db: List of confusion matrices
     :return: Comparison result
     """
-    cms_dict = {}
-    for cm_db in cms_db:
-        with open(os.path.join(PATH2CMS, cm_db.uid) + '.obj', "r") as file:
-            cm = pycm.ConfusionMatrix(file=file)
-            cms_dict[cm_db.uid] = cm
+    uids = [cm_db.uid for cm_db in cms_db]
+    if len(uids) > 1:
+        with ThreadPoolExecutor(max_workers=min(COMPARE_MAX_WORKERS, len(uids))) as executor:
+            cms = list(executor.map(_load_cm_obj, uids))
+    else:
+        cms = [_load_cm_obj(uid) for uid in uids]
+    cms_dict = dict(zip(uids, cms))
     compare = pycm.Compare(cms_dict)
-    return ConfusionMatrixCompareResponseBase(cm_uids=[cm_db.uid for cm_db in cms_db],
+    return ConfusionMatrixCompareResponseBase(cm_uids=uids,
                                               best_name=compare.best_name,
                                               cm_scores=compare.scores,
                                               cm_orders=compare.sorted)
 
 
+def _to_metric(value: float) -> float | str:
+    """
+    Convert a computed metric to PyCM's representation.
+
+    :param value: Metric value, NaN if undefined
+    :return: Metric as float or "None" if undefined
+    """
+    return "None" if np.isnan(value) else float(value)
+
+
+def _binary_cms_data(actual: np.ndarray, predict: np.ndarray, axis: int) -> List[ConfusionMatrixDataBase]:
+    """
+    Compute binary confusion matrices data along an axis of multi-hot matrices.
+
+    Matches `pycm.ConfusionMatrix` built on each 0/1 slice: metrics are macro
+    averaged over both classes, and any undefined per-class metric makes
+    the macro average "None".
+
+    :param actual: Boolean multi-hot actual matrix
+    :param predict: Boolean multi-hot predicted matrix
+    :param axis: 0 for per-class, 1 for per-sample confusion matrices
+    :return: List of confusion matrices data
+    """
+    tp = (actual & predict).sum(axis=axis)
+    fp = (~actual & predict).sum(axis=axis)
+    fn = (actual & ~predict).sum(axis=axis)
+    tn = (~actual & ~predict).sum(axis=axis)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        accuracy = (tp + tn) / (tp + fp + fn + tn)
+        precision = (tn / (tn + fn) + tp / (tp + fp)) / 2
+        recall = (tn / (tn + fp) + tp / (tp + fn)) / 2
+        f1 = ((2 * tn) / (2 * tn + fn + fp) + (2 * tp) / (2 * tp + fp + fn)) / 2
+    # A slice holding only ones is laid out by PyCM as classes [1, "~other~"]
+    only_positive = (tn + fp + fn) == 0
+    cms_data = []
+    for i in range(len(tp)):
+        if only_positive[i]:
+            confusion_matrix = [[int(tp[i]), 0], [0, 0]]
+        else:
+            confusion_matrix = [[int(tn[i]), int(fp[i])], [int(fn[i]), int(tp[i])]]
+        cms_data.append(ConfusionMatrixDataBase(accuracy=_to_metric(accuracy[i]),
+                                                precision=_to_metric(precision[i]),
+                                                recall=_to_metric(recall[i]),
+                                                f1=_to_metric(f1[i]),
+                                                confusion_matrix=confusion_matrix))
+    return cms_data
+
+
 def get_multi_label_cm(mlcm_req: MultiLabelConfusionMatrixCreate) -> MultiLabelConfusionMatrixResponseBase:
     """
     Get a multi-label confusion matrix.
@@ -176,8 +404,12 @@ def get_multi_label_cm(mlcm_req: MultiLabelConfusionMatrixCreate) -> MultiLabelC
     mlcm = pycm.MultiLabelCM(actual_vector=mlcm_req.actual_vector,
                              predict_vector=mlcm_req.predicted_vector,
                              classes=mlcm_req.classes)
+    actual = np.array(mlcm.actual_vector_multihot, dtype=bool)
+    predict = np.array(mlcm.predict_vector_multihot, dtype=bool)
+    cms_by_classes = _binary_cms_data(actual, predict, axis=0)
+    cms_by_samples = _binary_cms_data(actual, predict, axis=1)
     return MultiLabelConfusionMatrixResponseBase(multihot_actual=mlcm.actual_vector_multihot,
                                                  multihot_predicted=mlcm.predict_vector_multihot,
                                                  classes=mlcm.classes,
-                                                 cm_by_classes={class_name: ConfusionMatrixDataBase(cm=mlcm.get_cm_by_class(class_name)) for class_name in mlcm.classes},
-                                                 cm_by_samples={sample: ConfusionMatrixDataBase(cm=mlcm.get_cm_by_sample(sample)) for sample in range(len(mlcm.actual_vector))})
+                                                 cm_by_classes=dict(zip(mlcm.classes, cms_by_classes)),
+                                                 cm_by_samples=dict(enumerate(cms_by_samples)))